@@ -0,0 +1,142 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict
+from datetime import date
+from typing import Iterable, TextIO
+
+from models import DiaryHistory
+import querys
+
+
+'''
+日記履歴のエクスポート
+    ユーザーの日記・問題・選択肢・誤答フラグをJSONLまたはCSVで出力する
+    querys.iter_diary_history から1回のクエリの結果をページ単位で読み込み、1件ずつ書き出すため
+    日記の件数が多くてもメモリ使用量は一定になる
+    取得に失敗した場合は例外で異常終了する（途中までのファイルを正常な出力として扱わない）
+
+    使い方：
+        python export.py <user_id> [--format jsonl|csv] [--output ファイル名] [--page-size 件数] [--benchmark]
+'''
+# CSVの出力項目（問題1問につき1行）
+csv_fields = [
+    'diary_id', 'diary_date', 'original_text', 'english_text', 'japanese_text',
+    'number_of_correct_answers', 'question_no', 'question_text', 'explanation_text',
+    'mistake_flag', 'options', 'answer'
+]
+
+
+'''
+JSON変換できない値（日付）を文字列に変換する
+'''
+def to_json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value)}はJSONに変換できません')
+
+
+'''
+日記履歴をJSONL形式で書き出す（日記1件につき1行）
+書き出した行数を返す
+'''
+def write_jsonl(histories: Iterable[DiaryHistory], out: TextIO) -> int:
+    count = 0
+    for history in histories:
+        out.write(json.dumps(asdict(history), ensure_ascii=False, default=to_json_value))
+        out.write('\n')
+        count += 1
+    return count
+
+
+'''
+日記履歴をCSV形式で書き出す（問題1問につき1行、問題の無い日記は1行）
+書き出した行数を返す
+'''
+def write_csv(histories: Iterable[DiaryHistory], out: TextIO) -> int:
+    writer = csv.DictWriter(out, fieldnames=csv_fields)
+    writer.writeheader()
+    count = 0
+    for history in histories:
+        diary = history.diary
+        row = {
+            'diary_id': diary.id,
+            'diary_date': diary.diary_date.isoformat() if diary.diary_date else '',
+            'original_text': diary.original_text,
+            'english_text': diary.english_text,
+            'japanese_text': diary.japanese_text,
+            'number_of_correct_answers': diary.number_of_correct_answers,
+        }
+        if not history.questions:
+            writer.writerow(row)
+            count += 1
+            continue
+        for question_history in history.questions:
+            question = question_history.question
+            options = question_history.options
+            # 選択肢は「番号. テキスト」を改行でつなげて1項目にする
+            row.update({
+                'question_no': question.question_no,
+                'question_text': question.question_text,
+                'explanation_text': question.explanation_text,
+                'mistake_flag': bool(question.mistake_flag),
+                'options': '\n'.join(f'{option.option_no}. {option.option_text}' for option in options),
+                'answer': next((option.option_no for option in options if option.correct_flag), ''),
+            })
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+'''
+ユーザーの日記履歴を指定形式で書き出す
+書き出した行数を返す
+'''
+def export_diary_history(user_id: str, out: TextIO, format: str = 'jsonl', page_size: int = 1000) -> int:
+    histories = querys.iter_diary_history(user_id, page_size)
+    if format == 'csv':
+        return write_csv(histories, out)
+    return write_jsonl(histories, out)
+
+
+'''
+コマンドライン実行
+'''
+def main():
+    parser = argparse.ArgumentParser(description='ユーザーの日記履歴をエクスポートする')
+    parser.add_argument('user_id', help='LINEのユーザーID')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='出力形式')
+    parser.add_argument('--output', help='出力ファイル名（省略時は標準出力）')
+    parser.add_argument('--page-size', type=int, default=1000, help='クエリ結果を1回に読み込む行数')
+    parser.add_argument('--benchmark', action='store_true',
+        help='出力速度とピークメモリを標準エラーに出力する（ピークメモリは別の回で計測するため、クエリを2回実行する）')
+    args = parser.parse_args()
+
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        # 出力（ベンチマーク時は速度を計測する。tracemallocは処理を遅くするためこの回では使わない）
+        started = time.perf_counter()
+        count = export_diary_history(args.user_id, out, args.format, args.page_size)
+        elapsed = time.perf_counter() - started
+    finally:
+        if args.output:
+            out.close()
+
+    if args.benchmark:
+        # ピークメモリは別の回で計測する（出力は破棄する。クエリをもう一度実行するため、BigQueryの料金は2回分かかる）
+        tracemalloc.start()
+        with open(os.devnull, 'w', encoding='utf-8', newline='') as devnull:
+            export_diary_history(args.user_id, devnull, args.format, args.page_size)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rows_per_second = count / elapsed if elapsed > 0 else 0.0
+        print(f'rows={count} elapsed={elapsed:.2f}s rows/s={rows_per_second:.1f} '
+              f'peak_memory={peak / 1024 / 1024:.2f}MiB (measured in a separate traced pass)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+from google.cloud import bigquery, firestore
+import argparse
+import os
+import time
+import uuid
+from flask import jsonify
+from logging import getLogger, basicConfig, INFO
+from typing import Dict, List
+
+import opstore
+import querys
+
+'''
+変更ログのBigQueryへの反映
+    opstore.py が追記した変更ログ（Firestoreのchange_log）をテーブルごとに古い順にまとめて読み込み、
+    テーブルごとに実行ごとの一時テーブルへロードジョブで書き込んでから、1回のMERGEで各テーブル（TABLE_ID_*）に反映する
+    反映できた変更ログは削除する
+    同時に実行された場合に古い変更で上書きしないよう、Firestoreの排他ドキュメント（locks/exporter）で1つずつ実行する
+
+    使い方：
+        # Cloud Schedulerから数分おきに呼び出す
+        functions-framework --source exporter.py --target export
+        # 常駐して一定間隔で反映する
+        python exporter.py --interval 60
+        # Firestoreへの切り替え時に、BigQueryの各テーブルをFirestoreへ複製し、採番カウンターをBigQueryの最大IDに合わせる
+        python exporter.py --backfill
+        python exporter.py --seed-counters
+'''
+# 1回に読み込む変更ログの件数
+batch_size = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+# Firestoreへの複製で1バッチに書き込む件数（Firestoreの1バッチの上限は500件）
+backfill_batch_size = 500
+# 反映処理の排他用ドキュメント（同時に実行された反映処理が古い変更で上書きしないよう、1つずつ実行する）
+lease_collection = 'locks'
+lease_document = 'exporter'
+# 排他の有効期間（秒）。反映のたびに延長し、期限を過ぎた排他は異常終了した実行のものとして引き継ぐ
+lease_seconds = float(os.environ.get('EXPORT_LEASE_SECONDS', '600'))
+# 反映先のテーブルIDとキー項目
+export_tables = {
+    'user_status': (querys.table_id_user_status, ['user_id']),
+    'diary': (querys.table_id_diary, ['id']),
+    'question': (querys.table_id_question, ['id']),
+    'options': (querys.table_id_options, ['id']),
+    'user_stats': (querys.table_id_user_stats, ['user_id']),
+    'mistake_index': (querys.table_id_mistake_index, ['user_id', 'question_id']),
+}
+
+# loggerの取得
+logger = getLogger(__name__)
+
+
+'''
+HTTPエントリポイント（Cloud Schedulerから呼び出す）
+'''
+def export(request):
+    count = export_changes()
+    return jsonify({'message': 'ok', 'exported': count})
+
+
+class LeaseLost(Exception):
+    '''反映処理の排他を失ったことを表す例外'''
+
+
+'''
+変更ログを読み込んでBigQueryへ反映する
+反映した変更ログの件数を返す
+    他の反映処理が実行中の場合は何もせずに0を返す
+'''
+def export_changes() -> int:
+    owner = uuid.uuid4().hex
+    lease_ref = opstore.db.collection(lease_collection).document(lease_document)
+    if not take_lease(opstore.db.transaction(), lease_ref, owner):
+        logger.info('他の反映処理が実行中のため終了します')
+        return 0
+    exported = 0
+    try:
+        exported = export_changes_with_lease(lease_ref, owner)
+    except LeaseLost:
+        logger.warning('排他の期限が切れて他の反映処理に引き継がれたため、反映を中断します')
+    finally:
+        release_lease(opstore.db.transaction(), lease_ref, owner)
+    return exported
+
+
+'''
+排他を取得した状態で変更ログをテーブルごとに反映する
+    反映に失敗したテーブルは今回の実行ではそれ以上読み込まず、他のテーブルの反映を続ける
+    （失敗し続けるテーブルの変更ログが先頭に溜まっても、他のテーブルの反映を止めないため）
+'''
+def export_changes_with_lease(lease_ref, owner: str) -> int:
+    exported = 0
+    for table in export_tables:
+        exported += export_table_changes(table, lease_ref, owner)
+    return exported
+
+
+'''
+1テーブル分の変更ログを古い順にまとめて読み込み、反映する
+反映した変更ログの件数を返す
+    反映の前に排他を延長し、延長できなかった場合はLeaseLostを送出する
+'''
+def export_table_changes(table: str, lease_ref, owner: str) -> int:
+    keys = export_tables[table][1]
+    exported = 0
+    while True:
+        snapshots = list(opstore.db.collection(opstore.change_log_collection)
+            .where(filter=firestore.FieldFilter('table', '==', table))
+            .order_by('changed_at')
+            .limit(batch_size)
+            .get())
+        if not snapshots:
+            return exported
+        # キーが同じ変更は最後のものだけ残す（古い順に読み込むため後勝ち）
+        changes: Dict[tuple, dict] = {}
+        for snapshot in snapshots:
+            entry = snapshot.to_dict()
+            row = dict(entry['row'])
+            row['_op'] = entry['op']
+            changes[tuple(row.get(name) for name in keys)] = row
+        if not take_lease(opstore.db.transaction(), lease_ref, owner):
+            raise LeaseLost()
+        try:
+            merge_changes(table, list(changes.values()))
+        except Exception as e:
+            # 反映に失敗した変更ログは残して次回やり直す
+            # 失敗した変更より新しい変更を先に反映しないよう、このテーブルは今回の実行ではここで終える
+            logger.error(f'{table}の反映でエラー発生：{e}')
+            return exported
+        delete_change_log([snapshot.reference for snapshot in snapshots])
+        exported += len(snapshots)
+        if len(snapshots) < batch_size:
+            return exported
+
+
+'''
+反映処理の排他を取得（取得済みの場合は延長）する
+他の実行が期限内の排他を持っている場合はFalseを返す
+'''
+@firestore.transactional
+def take_lease(transaction, ref, owner: str) -> bool:
+    snapshot = ref.get(transaction=transaction)
+    now = time.time()
+    if snapshot.exists and snapshot.get('owner') != owner and snapshot.get('expires_at') > now:
+        return False
+    transaction.set(ref, {'owner': owner, 'expires_at': now + lease_seconds})
+    return True
+
+
+'''
+反映処理の排他を解放する（自分の排他の場合のみ）
+'''
+@firestore.transactional
+def release_lease(transaction, ref, owner: str):
+    snapshot = ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.get('owner') == owner:
+        transaction.delete(ref)
+
+
+'''
+変更をテーブルに反映する
+    一時テーブル（<テーブルID>_changes_<実行ごとのID>）へロードジョブで書き込み、MERGEで反映する
+    ロードジョブはDMLの回数制限を受けないため、件数によらずテーブルごとにDMLは1回になる
+    一時テーブルは実行ごとに別名で作成して最後に削除する
+    （Cloud Schedulerの呼び出しと常駐実行が重なっても、互いの一時テーブルを置き換えないため）
+'''
+def merge_changes(table: str, rows: List[dict]):
+    table_id, keys = export_tables[table]
+    staging_table_id = f'{table_id}_changes_{uuid.uuid4().hex}'
+    schema = querys.client.get_table(table_id).schema
+    columns = [field.name for field in schema]
+    job_config = bigquery.LoadJobConfig(
+        schema=schema + [bigquery.SchemaField('_op', 'STRING')],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
+    load_rows = [{name: row.get(name) for name in columns + ['_op']} for row in rows]
+    try:
+        # 一時テーブルへ書き込む
+        querys.client.load_table_from_json(load_rows, staging_table_id, job_config=job_config).result()
+        merge_staging_table(table_id, staging_table_id, keys, columns)
+    finally:
+        # 一時テーブルを削除する（失敗した場合も残さない）
+        querys.client.delete_table(staging_table_id, not_found_ok=True)
+    logger.info(f'{table}に{len(rows)}件反映しました')
+
+
+'''
+一時テーブルの内容をMERGEで反映する
+'''
+def merge_staging_table(table_id: str, staging_table_id: str, keys: List[str], columns: List[str]):
+    on = ' AND '.join(f'T.{name} = S.{name}' for name in keys)
+    update = ', '.join(f'{name} = S.{name}' for name in columns if name not in keys)
+    insert_columns = ', '.join(columns)
+    insert_values = ', '.join(f'S.{name}' for name in columns)
+    query = f'''MERGE `{table_id}` T
+                USING `{staging_table_id}` S
+                ON {on}
+                WHEN MATCHED AND S._op = 'delete' THEN
+                    DELETE
+                WHEN MATCHED THEN
+                    UPDATE SET {update}
+                WHEN NOT MATCHED AND S._op != 'delete' THEN
+                    INSERT ({insert_columns}) VALUES ({insert_values})
+            '''
+    querys.run_query(query, None, None)
+
+
+'''
+反映済みの変更ログを削除する（1バッチ500件まで）
+'''
+def delete_change_log(refs: List):
+    for start in range(0, len(refs), 500):
+        batch = opstore.db.batch()
+        for ref in refs[start:start + 500]:
+            batch.delete(ref)
+        batch.commit()
+
+
+'''
+BigQueryの各テーブルの行をFirestoreへ複製する（切り替え時に、会話処理をFirestoreへ向ける前に一度だけ実行する）
+    ドキュメントIDは opstore.py と同じくキー項目を「_」でつないだものにする
+    BigQueryには反映済みの内容のため、変更ログには追記しない
+'''
+def backfill():
+    for table, (table_id, keys) in export_tables.items():
+        count = 0
+        batch = opstore.db.batch()
+        # ページ単位で読み込む（テーブル全体をメモリに載せない）
+        for row in querys.client.list_rows(table_id, page_size=backfill_batch_size):
+            row = dict(row.items())
+            for name, value in row.items():
+                if name in opstore.date_fields and value is not None:
+                    row[name] = value.isoformat()
+            doc_id = '_'.join(str(row[name]) for name in keys)
+            batch.set(opstore.db.collection(table).document(doc_id), row)
+            count += 1
+            if count % backfill_batch_size == 0:
+                batch.commit()
+                batch = opstore.db.batch()
+        if count % backfill_batch_size:
+            batch.commit()
+        logger.info(f'{table}に{count}件複製しました')
+
+
+'''
+採番カウンターをBigQueryの各テーブルの最大IDに合わせる
+'''
+def seed_counters():
+    for table in ['diary', 'question', 'options']:
+        table_id = export_tables[table][0]
+        last_id = querys.get_id(table_id) - 1
+        opstore.db.collection(opstore.counter_collection).document(table).set({'value': last_id})
+        logger.info(f'{table}の採番カウンターを{last_id}に設定しました')
+
+
+'''
+コマンドライン実行
+'''
+def main():
+    parser = argparse.ArgumentParser(description='変更ログをBigQueryへ反映する')
+    parser.add_argument('--interval', type=float, help='反映の間隔（秒）。省略時は1回だけ反映する')
+    parser.add_argument('--backfill', action='store_true', help='BigQueryの各テーブルの行をFirestoreへ複製する')
+    parser.add_argument('--seed-counters', action='store_true', help='採番カウンターをBigQueryの最大IDに合わせる')
+    args = parser.parse_args()
+    basicConfig(level=INFO)
+
+    if args.backfill:
+        backfill()
+        return
+    if args.seed_counters:
+        seed_counters()
+        return
+    while True:
+        count = export_changes()
+        logger.info(f'変更ログ{count}件を反映しました')
+        if args.interval is None:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
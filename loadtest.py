@@ -0,0 +1,265 @@
+import argparse
+import base64, hashlib, hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+
+'''
+Webhookの負荷試験
+    記録したWebhookのボディ、または合成したセッション（日記作成・出題・解答・質問・復習）を
+    チャネルシークレットで署名し、ローカルのインスタンスへ指定の同時実行数・RPSで送信する
+    フローごとのスループット・レイテンシ分布・エラー率を出力する
+    擬似バックエンドへ送信した場合は、サーバーが実際に処理したフロー名（message:review など）で集計する
+
+    使い方：
+        # 擬似バックエンドでローカル起動（Gemini・ストレージの待ち時間は環境変数で指定）
+        LINE_CHANNEL_SECRET=xxx functions-framework --source loadtest_backend.py --target main
+        # 合成セッションを送信
+        python loadtest.py --url http://localhost:8080 --secret xxx --users 100 --concurrency 20 --rps 10
+        # 記録したボディを送信（1行に {"session": ..., "flow": ..., "body": ...}）
+        python loadtest.py --url http://localhost:8080 --secret xxx --recorded bodies.jsonl
+'''
+# レイテンシ分布の区切り（ミリ秒）
+histogram_buckets_ms = [100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000]
+
+
+'''
+Webhookのボディに署名する
+'''
+def sign(body: str, channel_secret: str) -> str:
+    hash = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(hash).decode()
+
+
+'''
+Webhookのイベントを1件含むボディを作成する
+'''
+def webhook_body(user_id: str, event: dict) -> str:
+    event.update({
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid.uuid4().hex,
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': uuid.uuid4().hex,
+    })
+    return json.dumps({'destination': 'loadtest', 'events': [event]}, ensure_ascii=False)
+
+
+def text_event(text: str) -> dict:
+    return {'type': 'message', 'message': {'id': uuid.uuid4().hex, 'type': 'text', 'text': text}}
+
+
+def postback_event(data: str) -> dict:
+    return {'type': 'postback', 'postback': {'data': data}}
+
+
+'''
+合成セッションを作成する（フロー名とボディの組のリスト）
+    日記作成 →（質問）→ 3問解答 → 雑談 → 復習（3問解答）を1ユーザー分の会話として並べる
+'''
+def synthetic_session(user_id: str, rng: random.Random) -> List[Tuple[str, str]]:
+    steps = [('diary', text_event('今日は友達とカフェに行って、新しいケーキを食べた。'))]
+    if rng.random() < 0.5:
+        # 半分のセッションは出題前に質問する
+        steps.append(('ask_question', postback_event('ask_question')))
+        for _ in range(rng.randint(1, 3)):
+            steps.append(('ask', text_event('この文章の主人公はどんな気持ちでしたか？')))
+    steps.append(('try_to_answer', postback_event('try_to_answer')))
+    for _ in range(3):
+        steps.append(('answer', text_event(str(rng.randint(1, 3)))))
+    steps.append(('chat', text_event('ありがとう！')))
+    steps.append(('review', postback_event('review_mistakes')))
+    # 復習する問題は誤答した問題（擬似バックエンドでは当日が復習期限）なので、最大3問解答する
+    for _ in range(3):
+        steps.append(('review_answer', text_event(str(rng.randint(1, 3)))))
+    return [(flow, webhook_body(user_id, event)) for flow, event in steps]
+
+
+'''
+記録したボディを読み込み、セッションごとにまとめる
+'''
+def recorded_sessions(path: str) -> List[List[Tuple[str, str]]]:
+    sessions: Dict[str, List[Tuple[str, str]]] = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = record['body']
+            if not isinstance(body, str):
+                body = json.dumps(body, ensure_ascii=False)
+            sessions.setdefault(record.get('session', ''), []).append((record.get('flow', 'recorded'), body))
+    return list(sessions.values())
+
+
+'''
+送信間隔を一定に保つレート制限（全スレッド共通）
+'''
+class RateLimiter:
+
+    def __init__(self, rps: Optional[float]):
+        self.interval = 1 / rps if rps else 0.0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(self.next_at, now)
+            self.next_at = wait_until + self.interval
+        time.sleep(max(wait_until - now, 0))
+
+
+'''
+フローごとの計測結果
+'''
+class FlowStats:
+
+    def __init__(self):
+        self.latencies_ms: List[float] = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency_ms: float, ok: bool):
+        with self.lock:
+            self.latencies_ms.append(latency_ms)
+            if not ok:
+                self.errors += 1
+
+    def percentile(self, p: float) -> float:
+        values = sorted(self.latencies_ms)
+        if not values:
+            return 0.0
+        return values[min(int(len(values) * p), len(values) - 1)]
+
+    def histogram(self) -> List[int]:
+        counts = [0] * (len(histogram_buckets_ms) + 1)
+        for latency in self.latencies_ms:
+            counts[bisect_left(histogram_buckets_ms, latency)] += 1
+        return counts
+
+
+'''
+負荷試験の実行
+'''
+class LoadTest:
+
+    def __init__(self, url: str, channel_secret: str, concurrency: int, rps: Optional[float],
+            duration: Optional[float], timeout: float):
+        self.url = url
+        self.channel_secret = channel_secret
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rps)
+        self.duration = duration
+        self.timeout = timeout
+        self.stats: Dict[str, FlowStats] = {}
+        self.stats_lock = threading.Lock()
+        self.local = threading.local()
+
+    def flow_stats(self, flow: str) -> FlowStats:
+        with self.stats_lock:
+            return self.stats.setdefault(flow, FlowStats())
+
+    def send(self, flow: str, body: str):
+        # スレッドごとにセッションを使い回す
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        self.limiter.acquire()
+        headers = {'Content-Type': 'application/json', 'X-Line-Signature': sign(body, self.channel_secret)}
+        started = time.perf_counter()
+        try:
+            response = session.post(self.url, data=body.encode('utf-8'), headers=headers, timeout=self.timeout)
+            ok = response.status_code < 400
+            # 擬似バックエンドが実際に処理したフロー名を返した場合はそのフロー名で集計する
+            flow = response.headers.get('X-Loadtest-Flow', flow)
+        except requests.RequestException:
+            ok = False
+        self.flow_stats(flow).record((time.perf_counter() - started) * 1000, ok)
+
+    def run_session(self, steps: List[Tuple[str, str]]):
+        # 1セッション内のイベントは順番に送る
+        for flow, body in steps:
+            if self.expired():
+                return
+            self.send(flow, body)
+
+    def expired(self) -> bool:
+        return self.duration is not None and time.monotonic() - self.started >= self.duration
+
+    def run(self, sessions: List[List[Tuple[str, str]]]) -> float:
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self.run_session, sessions))
+        return time.monotonic() - self.started
+
+    '''
+    計測結果を表形式で出力する
+    '''
+    def report(self, elapsed: float):
+        print(f'elapsed={elapsed:.1f}s concurrency={self.concurrency}')
+        print(f'{"flow":<26}{"count":>7}{"rps":>8}{"err%":>7}{"p50ms":>9}{"p90ms":>9}{"p99ms":>9}{"maxms":>9}')
+        total = FlowStats()
+        for flow, stats in sorted(self.stats.items()):
+            self.print_row(flow, stats, elapsed)
+            total.latencies_ms.extend(stats.latencies_ms)
+            total.errors += stats.errors
+        self.print_row('total', total, elapsed)
+        print()
+        labels = [f'<={bucket}' for bucket in histogram_buckets_ms] + [f'>{histogram_buckets_ms[-1]}']
+        print(f'{"histogram(ms)":<26}' + ''.join(f'{label:>8}' for label in labels))
+        for flow, stats in sorted(self.stats.items()):
+            print(f'{flow:<26}' + ''.join(f'{count:>8}' for count in stats.histogram()))
+
+    def print_row(self, flow: str, stats: FlowStats, elapsed: float):
+        count = len(stats.latencies_ms)
+        error_rate = stats.errors / count * 100 if count else 0.0
+        print(f'{flow:<26}{count:>7}{count / elapsed:>8.2f}{error_rate:>7.1f}'
+              f'{stats.percentile(0.5):>9.0f}{stats.percentile(0.9):>9.0f}'
+              f'{stats.percentile(0.99):>9.0f}{max(stats.latencies_ms, default=0):>9.0f}')
+
+
+'''
+コマンドライン実行
+'''
+def main():
+    parser = argparse.ArgumentParser(description='Webhookの負荷試験')
+    parser.add_argument('--url', default='http://localhost:8080', help='送信先のURL')
+    parser.add_argument('--secret', default=os.environ.get('LINE_CHANNEL_SECRET'), help='チャネルシークレット')
+    parser.add_argument('--recorded', help='記録したボディのJSONLファイル（省略時は合成セッション）')
+    parser.add_argument('--users', type=int, default=50, help='合成セッションのユーザー数')
+    parser.add_argument('--concurrency', type=int, default=10, help='同時に進めるセッション数')
+    parser.add_argument('--rps', type=float, help='1秒あたりの送信数の上限（省略時は無制限）')
+    parser.add_argument('--duration', type=float, help='試験時間（秒）。省略時は全セッション終了まで')
+    parser.add_argument('--timeout', type=float, default=65, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--seed', type=int, default=0, help='合成セッションの乱数シード')
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error('--secret または LINE_CHANNEL_SECRET を指定してください')
+
+    if args.recorded:
+        sessions = recorded_sessions(args.recorded)
+    else:
+        rng = random.Random(args.seed)
+        run_id = uuid.uuid4().hex[:8]
+        sessions = [synthetic_session(f'Uload{run_id}{n:05d}', rng) for n in range(args.users)]
+
+    load_test = LoadTest(args.url, args.secret, args.concurrency, args.rps, args.duration, args.timeout)
+    elapsed = load_test.run(sessions)
+    load_test.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
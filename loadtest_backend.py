@@ -0,0 +1,295 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import replace
+from datetime import timedelta
+from typing import Optional
+
+from google.cloud import bigquery, firestore
+
+
+'''
+負荷試験用の擬似バックエンド
+    データストア・Gemini・LINE APIの代わりにメモリ上のデータと指定した待ち時間で応答する
+    main.main をそのまま動かすため、opstore の関数と main の外部呼び出しを差し替える
+
+    誤答した問題はその日のうちに復習できるよう、復習期限を前倒しして登録する（LOADTEST_REVIEW_DUE_OFFSET_DAYS）
+
+    使い方：
+        LINE_CHANNEL_SECRET=xxx LOADTEST_GEMINI_LATENCY_MS=3000 LOADTEST_STORAGE_LATENCY_MS=800 \
+            functions-framework --source loadtest_backend.py --target main
+'''
+# Geminiの待ち時間（ミリ秒）
+gemini_latency_ms = float(os.environ.get('LOADTEST_GEMINI_LATENCY_MS', '3000'))
+# ストレージ（Firestore）の待ち時間（ミリ秒）
+storage_latency_ms = float(os.environ.get('LOADTEST_STORAGE_LATENCY_MS', '800'))
+# LINE APIの待ち時間（ミリ秒）
+line_latency_ms = float(os.environ.get('LOADTEST_LINE_LATENCY_MS', '100'))
+# 待ち時間のばらつき（0.5なら指定値の±50%）
+latency_jitter = float(os.environ.get('LOADTEST_LATENCY_JITTER', '0.3'))
+# 誤答インデックスの復習期限を前倒しする日数（1なら誤答した当日に復習できる）
+review_due_offset_days = int(os.environ.get('LOADTEST_REVIEW_DUE_OFFSET_DAYS', '1'))
+
+# 認証情報が無くても main を読み込めるように、BigQuery・Firestoreクライアントを生成しないようにする
+bigquery.Client = lambda *args, **kwargs: None
+firestore.Client = lambda *args, **kwargs: None
+
+import main as app
+import opstore
+from resilience import DeadlineExceeded
+
+
+'''
+指定した待ち時間（ばらつき付き）だけ待つ
+処理期限までに終わらない場合は期限まで待ってDeadlineExceededを送出する
+'''
+def wait(latency_ms: float, deadline=None):
+    seconds = latency_ms / 1000 * random.uniform(1 - latency_jitter, 1 + latency_jitter)
+    if deadline is not None and seconds > deadline.remaining():
+        time.sleep(deadline.remaining())
+        raise DeadlineExceeded('擬似バックエンドの処理が期限内に終わりませんでした')
+    time.sleep(seconds)
+
+
+'''
+メモリ上のテーブル
+'''
+class MemoryStore:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_status = {}
+        self.diary = {}
+        self.question = {}
+        self.options = {}
+        self.user_stats = {}
+        self.mistake_index = {}
+        self.next_id = 0
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+
+store = MemoryStore()
+
+
+def insert_user_status(userStatus, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.user_status[userStatus.user_id] = replace(userStatus)
+
+
+def insert_diary(diaryEntry, deadline=None) -> Optional[int]:
+    wait(storage_latency_ms, deadline)
+    id = store.new_id()
+    store.diary[id] = replace(diaryEntry, id=id)
+    return id
+
+
+def insert_question(questionEntry, deadline=None) -> Optional[int]:
+    wait(storage_latency_ms, deadline)
+    id = store.new_id()
+    store.question[id] = replace(questionEntry, id=id)
+    return id
+
+
+def insert_option(optionEntry, deadline=None):
+    wait(storage_latency_ms, deadline)
+    id = store.new_id()
+    store.options[id] = replace(optionEntry, id=id)
+
+
+def select_user_status(user_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    row = store.user_status.get(user_id)
+    return replace(row) if row else None
+
+
+def select_diary(id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    row = store.diary.get(id)
+    return replace(row) if row else None
+
+
+def select_question(diary_id, question_no, deadline=None):
+    wait(storage_latency_ms, deadline)
+    for row in list(store.question.values()):
+        if row.diary_id == diary_id and row.question_no == question_no:
+            return replace(row)
+    return None
+
+
+def select_question_by_id(id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    row = store.question.get(id)
+    return replace(row) if row else None
+
+
+def select_questions_by_diary_ids(diary_ids, deadline=None):
+    wait(storage_latency_ms, deadline)
+    return [replace(row) for row in list(store.question.values()) if row.diary_id in diary_ids]
+
+
+def select_option(question_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    rows = [replace(row) for row in list(store.options.values()) if row.question_id == question_id]
+    return sorted(rows, key=lambda row: row.option_no)
+
+
+def is_correct(question_id, option_no, deadline=None) -> bool:
+    wait(storage_latency_ms, deadline)
+    return any(row.question_id == question_id and row.option_no == option_no and row.correct_flag
+        for row in list(store.options.values()))
+
+
+def update_user_status(userStatus, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.user_status[userStatus.user_id] = replace(userStatus)
+
+
+def update_diary(diaryEntry, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.diary[diaryEntry.id].number_of_correct_answers = diaryEntry.number_of_correct_answers
+
+
+def update_question(question_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.question[question_id].mistake_flag = True
+
+
+def select_user_stats(user_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    return store.user_stats.get(user_id)
+
+
+def upsert_user_stats(userStats, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.user_stats[userStats.user_id] = userStats
+
+
+def select_mistake(user_id, question_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    return store.mistake_index.get((user_id, question_id))
+
+
+def select_next_mistake(user_id, today, exclude_question_id=None, deadline=None):
+    wait(storage_latency_ms, deadline)
+    entries = [entry for (entry_user_id, question_id), entry in list(store.mistake_index.items())
+        if entry_user_id == user_id and entry.due_date <= today and question_id != exclude_question_id]
+    return min(entries, key=lambda entry: (entry.due_date, entry.question_id), default=None)
+
+
+def upsert_mistake(mistakeEntry, deadline=None):
+    wait(storage_latency_ms, deadline)
+    # 1回のセッションで復習まで流せるよう、復習期限を前倒しして登録する
+    mistakeEntry = replace(mistakeEntry, due_date=mistakeEntry.due_date - timedelta(days=review_due_offset_days))
+    store.mistake_index[(mistakeEntry.user_id, mistakeEntry.question_id)] = mistakeEntry
+
+
+def delete_mistake(user_id, question_id, deadline=None):
+    wait(storage_latency_ms, deadline)
+    store.mistake_index.pop((user_id, question_id), None)
+
+
+'''
+Geminiの代わりに固定の日記・応答を返す
+'''
+def generate_ai_message(message, response_mime_type, system_prompt, deadline=None) -> str:
+    wait(gemini_latency_ms, deadline)
+    if response_mime_type != 'application/json':
+        return f'(load test) {message}'
+    return json.dumps({
+        'original': f'(load test) {message}',
+        'translation': f'（負荷試験）{message}',
+        'exercises': [{
+            'question_no': question_no,
+            'question': f'Question {question_no}',
+            'options': [{'option_no': option_no, 'option': f'Option {option_no}'} for option_no in range(1, 4)],
+            'answer': random.randint(1, 3),
+            'explanation': f'解説{question_no}',
+            'question_type': random.choice(['語彙', '文法', '内容理解', '推論'])
+        } for question_no in range(1, 4)]
+    })
+
+
+def start_loading_animation(user_id, deadline=None):
+    wait(line_latency_ms, deadline)
+
+
+def reply_message(self, reply_token, messages, *args, **kwargs):
+    wait(line_latency_ms)
+
+
+def push_message(self, to, messages, *args, **kwargs):
+    wait(line_latency_ms)
+
+
+# イベント処理のスレッドで作成したTaskGraph
+flow_local = threading.local()
+# 応答トークンごとのTaskGraph（応答ヘッダーにフロー名を返すまで保持する）
+event_graphs = {}
+# 差し替え前のイベント処理とエントリポイント
+app_handle_event = app.handle_event
+app_main = app.main
+
+
+'''
+作成時にイベント処理のスレッドへ自身を記録するTaskGraph
+'''
+class RecordingTaskGraph(app.TaskGraph):
+
+    def __init__(self, flow: str):
+        super().__init__(flow)
+        graphs = getattr(flow_local, 'graphs', None)
+        if graphs is not None:
+            graphs.append(self)
+
+
+'''
+イベント処理（作成したTaskGraphを応答トークンに紐付けて記録する）
+'''
+def handle_event(event, deadline):
+    flow_local.graphs = event_graphs.get(event.reply_token)
+    try:
+        return app_handle_event(event, deadline)
+    finally:
+        flow_local.graphs = None
+
+
+'''
+functions-framework のエントリポイント
+    サーバーで実際に処理したフロー名を応答ヘッダー（X-Loadtest-Flow）で返す
+    loadtest.py はこのフロー名で集計する（送信側の想定と実際の処理が異なる場合があるため）
+'''
+def main(request):
+    body = request.get_json(silent=True) or {}
+    tokens = [event.get('replyToken') for event in body.get('events', []) if event.get('replyToken')]
+    for token in tokens:
+        event_graphs[token] = []
+    try:
+        response = app_main(request)
+    finally:
+        graphs = [graph for token in tokens for graph in event_graphs.pop(token, [])]
+    if graphs:
+        response.headers['X-Loadtest-Flow'] = ','.join(graph.flow for graph in graphs)
+    return response
+
+
+# opstore の関数と main の外部呼び出しを差し替える
+for name in [
+        'insert_user_status', 'insert_diary', 'insert_question', 'insert_option',
+        'select_user_status', 'select_diary', 'select_question', 'select_question_by_id',
+        'select_questions_by_diary_ids', 'select_option', 'is_correct',
+        'update_user_status', 'update_diary', 'update_question',
+        'select_user_stats', 'upsert_user_stats',
+        'select_mistake', 'select_next_mistake', 'upsert_mistake', 'delete_mistake']:
+    setattr(opstore, name, globals()[name])
+app.generate_ai_message = generate_ai_message
+app.start_loading_animation = start_loading_animation
+app.LineBotApi.reply_message = reply_message
+app.LineBotApi.push_message = push_message
+app.TaskGraph = RecordingTaskGraph
+app.handle_event = handle_event
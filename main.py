@@ -7,6 +7,8 @@ from datetime import datetime, date
 import pytz
 import requests
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from logging import getLogger
 
 from linebot import (
     LineBotApi, WebhookParser
@@ -19,7 +21,11 @@ from linebot.models import (
 )
 
 from models import UserStatus, Diary, Question, Options
-import querys
+import opstore
+import stats
+import review
+from taskgraph import TaskGraph
+from resilience import Deadline, DeadlineExceeded, CircuitBreaker, Unavailable
 
 
 '''
@@ -31,6 +37,10 @@ channel_access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 channel_secret = os.environ.get('LINE_CHANNEL_SECRET')
 # GEMINI_APIKEY
 gemini_api_key = os.environ.get('GEMINI_API_KEY')
+# リクエスト全体の処理期限（秒）
+request_budget_seconds = float(os.environ.get('REQUEST_BUDGET_SECONDS', '50'))
+# 応答期限（秒）。過ぎた場合は作成中のメッセージを返し、結果は後でプッシュで送る
+reply_deadline_seconds = float(os.environ.get('REPLY_DEADLINE_SECONDS', '30'))
 # 日記作成のシステムプロンプト
 system_prompt_diary = f"""
 与えられた文章から日記を生成し、JSON形式で答えてください。
@@ -50,6 +60,7 @@ system_prompt_diary = f"""
     ・問題文と選択肢を英語で作成してください。
     ・正答番号を指定してください。選択肢の1番目が正解なら1、2番目が正解なら2...というようにしてください。
     ・正解解説を日本語で作成してください
+    ・問題の種類を「語彙」「文法」「内容理解」「推論」の中から1つ指定してください
 5. JSON形式で以下の通り項目を設定してください。
     original : 2.で作成した英文。
     translation : 3.で作成した訳文。
@@ -61,6 +72,7 @@ system_prompt_diary = f"""
             option : 選択肢のテキスト。
         answer : 4.で作成した問題の正解。option_noに合わせる。
         explanation : 4.で作成した問題の日本語解説文。
+        question_type : 4.で指定した問題の種類。
 """
 # 質問用のシステムプロンプト
 system_prompt_asking = """
@@ -69,6 +81,17 @@ system_prompt_asking = """
 和訳：{japanese_text}
 """
 
+# 縮退応答のメッセージ
+degraded_message_pending = 'ただいま作成中です…できあがり次第お送りします。'
+degraded_message_unavailable = 'ただいま混み合っています。少し時間をおいてからもう一度送ってください。'
+
+# loggerの取得
+logger = getLogger(__name__)
+# Geminiの遮断器
+gemini_breaker = CircuitBreaker('Gemini')
+# イベント処理用のスレッドプール（TaskGraphとは別にして待ち合わせで詰まらないようにする）
+handler_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='handler')
+
 '''
 メイン処理
 '''
@@ -91,125 +114,255 @@ def main(request):
     except InvalidSignatureError:
         return abort(405)
 
+    # リクエスト全体の処理期限と応答期限
+    deadline = Deadline(request_budget_seconds)
+    reply_deadline = Deadline(reply_deadline_seconds)
+
     for event in events:
-        # 返信用変数準備
-        reply_data = []
-        # ローディングアニメーション
-        url_loading = 'https://api.line.me/v2/bot/chat/loading/start'
-        headers_loading = {
-            'Content-Type': 'application/json',
-            "Authorization": f'Bearer {channel_access_token}'
-        }
-        payload_loading = {
-            "chatId": event.source.user_id,
-            "loadingSeconds": 40
-        }
-        if isinstance(event, MessageEvent):
-            # メッセージを受信した場合
-            response = requests.post(url_loading, headers=headers_loading, data=json.dumps(payload_loading)) 
-            if isinstance(event.message, TextMessage):
-                # タイムゾーン設定
-                timezone_japan = pytz.timezone('Asia/Tokyo')
-                # 日本時間の現在時刻を取得
-                now_japan = datetime.now(pytz.utc).astimezone(timezone_japan)
-                # 日付のみに絞り込む
-                today = now_japan.date()
-                # テキストメッセージならユーザーステータステーブルを検索
-                user_status = querys.select_user_status(event.source.user_id)
-                if user_status is None:
-                    # ユーザーステータスが存在しない場合、日記データを新規作成
-                    diary_id = create_diary(event.source.user_id, event.message.text, today)
-                    # 新規ユーザーステータスを編集
-                    user_status = UserStatus(
-                        user_id=event.source.user_id,
-                        status='0',
-                        current_diary_id=diary_id,
-                        current_question_no=None,
-                        latest_diary_date=today
-                    )
-                    # ユーザーステータスを新規作成
-                    querys.insert_user_status(user_status)
-                elif user_status.current_diary_id is None:
-                    # 処理中の日記IDが未設定の場合
-                    if user_status.latest_diary_date == today:
-                        # 今日の日記が処理された後であればメッセージをそのままAIに送って応答を返す
-                        response = generate_ai_message(event.message.text, "text/plain", None)
-                        reply_data.append(TextSendMessage(text=response))
-                        line_bot_api.reply_message(event.reply_token, reply_data)
-                        return jsonify({ 'message': 'ok'})
+        # イベント処理を別スレッドで開始し、応答期限まで待つ
+        future = handler_executor.submit(handle_event, event, deadline)
+        try:
+            reply_data = future.result(timeout=reply_deadline.remaining())
+        except FutureTimeoutError:
+            # 応答期限までに終わらない場合は、作成中のメッセージを先に返す
+            line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=degraded_message_pending)])
+            # 処理期限まで待って、終わった内容をプッシュで送る
+            try:
+                reply_data = future.result(timeout=deadline.remaining())
+            except Exception as e:
+                logger.warning(f'応答期限後の処理に失敗：{e}')
+                reply_data = [TextSendMessage(text=degraded_message_unavailable)]
+            if reply_data:
+                line_bot_api.push_message(event.source.user_id, reply_data)
+            continue
+        except Unavailable as e:
+            # 期限切れ・遮断中の場合は、待たずに縮退応答を返す
+            logger.warning(f'縮退応答を返却：{e}')
+            line_bot_api.reply_message(event.reply_token, [TextSendMessage(text=degraded_message_unavailable)])
+            continue
+
+        if reply_data:
+            # 応答内容をLINEで送信
+            line_bot_api.reply_message(event.reply_token, reply_data)
+
+    return jsonify({ 'message': 'ok'})
+
+
+'''
+イベント処理
+    イベントに応じてデータを更新し、返信するメッセージのリストを返す
+    外部サービスの呼び出しにはすべて処理期限（deadline）を渡す
+'''
+def handle_event(event, deadline: Deadline) -> list:
+    # 返信用変数準備
+    reply_data = []
+    if isinstance(event, MessageEvent):
+        # メッセージを受信した場合
+        with TaskGraph('message') as graph:
+            # ローディングアニメーション（応答を待たずに後続の処理を進める）
+            graph.add('loading', start_loading_animation, event.source.user_id, deadline)
+            if not isinstance(event.message, TextMessage):
+                return reply_data
+            # テキストメッセージならユーザーステータステーブルを検索
+            graph.add('user_status', opstore.select_user_status, event.source.user_id, deadline)
+            # 日本時間の今日の日付を取得
+            today = today_in_japan()
+            user_status = graph.get('user_status')
+            left_review = False
+            if user_status is not None and user_status.status == '3' and (
+                    not event.message.text.isdigit() or user_status.latest_diary_date != today):
+                # 復習中に選択肢番号以外を受信した場合や日付が変わった場合は、復習を終えて通常の処理に戻る
+                user_status.status = '0'
+                user_status.current_diary_id = None
+                user_status.current_question_no = None
+                left_review = True
+            if user_status is None:
+                graph.flow = 'message:new_user'
+                # ユーザーステータスが存在しない場合、日記データを新規作成
+                diary_id = graph.call('create_diary', create_diary, event.source.user_id, event.message.text, today, deadline)
+                # 新規ユーザーステータスを編集
+                user_status = UserStatus(
+                    user_id=event.source.user_id,
+                    status='0',
+                    current_diary_id=diary_id,
+                    current_question_no=None,
+                    latest_diary_date=today
+                )
+                # ユーザーステータスを新規作成
+                graph.call('insert_user_status', opstore.insert_user_status, user_status, deadline)
+            elif user_status.current_diary_id is None:
+                # 処理中の日記IDが未設定の場合
+                if user_status.latest_diary_date == today:
+                    graph.flow = 'message:chat'
+                    if left_review:
+                        # 復習を終えた場合はユーザーステータスを更新（AI応答の生成と並行して実行）
+                        graph.add('update_user_status', opstore.update_user_status, user_status, deadline)
+                    # 今日の日記が処理された後であればメッセージをそのままAIに送って応答を返す
+                    response = graph.call('generate_ai_message', generate_ai_message, event.message.text, "text/plain", None, deadline)
+                    reply_data.append(TextSendMessage(text=response))
+                    if left_review:
+                        graph.get('update_user_status')
+                    return reply_data
+                else:
+                    graph.flow = 'message:new_diary'
+                    # 今日の日記が未作成の場合、日記データを新規作成
+                    diary_id = graph.call('create_diary', create_diary, event.source.user_id, event.message.text, today, deadline)
+                    # ユーザーステータスを編集
+                    user_status.current_diary_id = diary_id
+                    user_status.latest_diary_date = today
+
+            if user_status.status != '3':
+                # 復習中以外の場合、日記データを検索
+                graph.add('diary', opstore.select_diary, user_status.current_diary_id, deadline)
+            # 更新処理の名前（応答前に完了を待つ）
+            updates = []
+            if user_status.status == '1' :
+                graph.flow = 'message:answer'
+                # ステータスが出題中の場合、問題データを取得する
+                graph.add('question', opstore.select_question, user_status.current_diary_id, user_status.current_question_no, deadline)
+                # 受信したメッセージが正解かどうかを判定する
+                graph.add('is_correct', lambda question: opstore.is_correct(question_id=question.id, option_no=int(event.message.text), deadline=deadline),
+                    deps=['question'])
+                if user_status.current_question_no != 3:
+                    # 次の問題は正誤判定と並行して作成しておく
+                    graph.add('next_question', edit_question, user_status.current_diary_id, user_status.current_question_no + 1, deadline)
+                else:
+                    # 最終問題の場合は成績集計用に日記の問題とユーザー成績、復習する問題の有無を並行して取得しておく
+                    graph.add('questions', opstore.select_questions_by_diary_ids, [user_status.current_diary_id], deadline)
+                    graph.add('user_stats', opstore.select_user_stats, event.source.user_id, deadline)
+                    graph.add('next_mistake', opstore.select_next_mistake, event.source.user_id, today, None, deadline)
+                question = graph.get('question')
+                diary = graph.get('diary')
+                correct = graph.get('is_correct')
+                if correct:
+                    # 正解の場合は日記データの正答数を更新する
+                    diary.number_of_correct_answers += 1
+                    graph.add('update_diary', opstore.update_diary, diary, deadline)
+                    updates.append('update_diary')
+                    # メッセージを追加
+                    reply_data.append(TextSendMessage(text='正解です！'))
+                else:
+                    # 不正解の場合は問題の誤答フラグを更新し、誤答インデックスに登録する
+                    graph.add('update_question', opstore.update_question, question.id, deadline)
+                    updates.append('update_question')
+                    graph.add('upsert_mistake', opstore.upsert_mistake,
+                        review.schedule_mistake(event.source.user_id, question.id, today), deadline)
+                    updates.append('upsert_mistake')
+                    # メッセージを追加
+                    reply_data.append(TextSendMessage(text='不正解です。'))
+                # メッセージに解説文を追加
+                reply_data.append(TextSendMessage(text=question.explanation_text))
+                if user_status.current_question_no == 3:
+                    # 処理中の問題数が3の場合、出題終了としてユーザーステータスを変更
+                    user_status.status = '0'
+                    user_status.current_diary_id = None
+                    user_status.current_question_no = None
+                    # 今回の問題のうち不正解だった問題の種類を集める（今回の問題は誤答フラグの更新前のため判定結果を使う）
+                    missed_types = [q.question_type for q in graph.get('questions')
+                        if (not correct if q.id == question.id else q.mistake_flag)]
+                    # 成績発表メッセージを編集
+                    reply_data.append(TextSendMessage(text=f'今日は3問中{diary.number_of_correct_answers}問正解しました！'))
+                    try:
+                        previous_stats = graph.get('user_stats')
+                    except Exception as e:
+                        # 成績を取得できなかった場合（期限切れ・遮断中を含む）は、これまでの成績を上書きしないよう更新を見送る
+                        # 解答結果の更新は送信済みのため、縮退応答にせずに通常どおり応答する
+                        logger.error(f'ユーザー成績の取得に失敗したため更新を見送ります：{e}')
                     else:
-                        # 今日の日記が未作成の場合、日記データを新規作成
-                        diary_id = create_diary(event.source.user_id, event.message.text, today)
-                        # ユーザーステータスを編集
-                        user_status.current_diary_id = diary_id
-                        user_status.latest_diary_date = today
-
-                # 日記データを検索
-                diary = querys.select_diary(user_status.current_diary_id)
-                if user_status.status == '1' :
-                    # ステータスが出題中の場合、問題データを取得する
-                    question = querys.select_question(user_status.current_diary_id, user_status.current_question_no)
-                    # 受信したメッセージが正解かどうかを判定する
-                    if querys.is_correct(question_id=question.id, option_no=int(event.message.text)):
-                        # 正解の場合は日記データの正答数を更新する
-                        diary.number_of_correct_answers += 1
-                        querys.update_diary(diary)
-                        # メッセージを追加
-                        reply_data.append(TextSendMessage(text='正解です！'))
+                        # ユーザー成績を更新
+                        user_stats = stats.apply_quiz_result(previous_stats, event.source.user_id, today,
+                            diary.number_of_correct_answers, 3, missed_types)
+                        graph.add('upsert_user_stats', opstore.upsert_user_stats, user_stats, deadline)
+                        updates.append('upsert_user_stats')
+                        reply_data.append(TextSendMessage(text=stats.progress_message(user_stats, today)))
+                    # 和訳を編集（復習する問題があれば復習ボタンを付ける）
+                    if graph.get('next_mistake') is not None:
+                        reply_data.append(TextSendMessage(text=diary.japanese_text, quick_reply=review_quick_reply()))
                     else:
-                        # 不正解の場合は問題の誤答フラグを更新する
-                        querys.update_question(question.id)
-                        # メッセージを追加
-                        reply_data.append(TextSendMessage(text='不正解です。'))
-                    # メッセージに解説文を追加
-                    reply_data.append(TextSendMessage(text=question.explanation_text))
-                    if user_status.current_question_no == 3:
-                        # 処理中の問題数が3の場合、出題終了としてユーザーステータスを変更
-                        user_status.status = '0'
-                        user_status.current_diary_id = None
-                        user_status.current_question_no = None
-                        # 成績発表メッセージを編集
-                        reply_data.append(TextSendMessage(text=f'今日は3問中{diary.number_of_correct_answers}問正解しました！'))
-                        # 和訳を編集
                         reply_data.append(TextSendMessage(text=diary.japanese_text))
+                else:
+                    # 処理中の問題番号が3以外の場合、次の問題を作成
+                    user_status.current_question_no += 1
+                    reply_data.append(graph.get('next_question'))
+            elif user_status.status == '3':
+                graph.flow = 'message:review'
+                # 復習中の場合、問題データと誤答インデックスを取得する
+                graph.add('question', opstore.select_question, user_status.current_diary_id, user_status.current_question_no, deadline)
+                graph.add('is_correct', lambda question: opstore.is_correct(question_id=question.id, option_no=int(event.message.text), deadline=deadline),
+                    deps=['question'])
+                graph.add('mistake', lambda question: opstore.select_mistake(event.source.user_id, question.id, deadline),
+                    deps=['question'])
+                # 次に復習する問題を並行して探しておく（今回の問題は除く）
+                graph.add('next_mistake', lambda question: opstore.select_next_mistake(event.source.user_id, today, question.id, deadline),
+                    deps=['question'])
+                question = graph.get('question')
+                correct = graph.get('is_correct')
+                reply_data.append(TextSendMessage(text='正解です！' if correct else '不正解です。'))
+                reply_data.append(TextSendMessage(text=question.explanation_text))
+                try:
+                    mistake = graph.get('mistake')
+                except Exception as e:
+                    # 誤答インデックスを取得できなかった場合は、復習予定を消さないよう更新を見送る
+                    logger.error(f'誤答インデックスの取得に失敗したため更新を見送ります：{e}')
+                else:
+                    # 解答結果から次の復習予定を決めて誤答インデックスを更新する
+                    entry = review.schedule_review(mistake, event.source.user_id, question.id, correct, today)
+                    if entry is not None:
+                        graph.add('update_mistake', opstore.upsert_mistake, entry, deadline)
                     else:
-                        # 処理中の問題番号が3以外の場合、次の問題を作成
-                        user_status.current_question_no += 1
-                        reply_data.append(edit_question(diary.id, user_status.current_question_no))
-                elif user_status.status == '2':
-                    # 質問中の場合、AI応答を生成して応答を返す
-                    response = generate_ai_message(event.message.text, "text/plain", 
-                            system_prompt_asking.format(english_text=diary.english_text, 
-                            japanese_text=diary.japanese_text))
-                    response += '\n' + '（ほかに質問があれば続けてください）'
-                    quick_Action = [QuickReplyButton(action=PostbackAction(label='問題を解く', data='try_to_answer',display_text='問題を解く'))]
-                    reply_data.append(TextSendMessage(text=response,quick_reply=QuickReply(items=quick_Action)))
+                        graph.add('update_mistake', opstore.delete_mistake, event.source.user_id, question.id, deadline)
+                    updates.append('update_mistake')
+                next_mistake = graph.get('next_mistake')
+                next_question = graph.call('next_review_question', opstore.select_question_by_id, next_mistake.question_id, deadline) if next_mistake else None
+                if next_question is not None:
+                    # 次の問題を出題
+                    user_status.current_diary_id = next_question.diary_id
+                    user_status.current_question_no = next_question.question_no
+                    reply_data.append(graph.call('edit_question', edit_question, next_question.diary_id, next_question.question_no, deadline))
                 else:
-                    # 上記以外の場合、クイックリプライにPostbackアクションを入れたボタンを作る
-                    quick_Action = [QuickReplyButton(action=PostbackAction(label='問題を解く', data='try_to_answer',display_text='問題を解く'))
-                        ,QuickReplyButton(action=PostbackAction(label='質問する', data='ask_question',display_text='質問する'))]
-                    # 日記の英文をメッセージに編集
-                    reply_data.append(TextSendMessage(text=diary.english_text,quick_reply=QuickReply(items=quick_Action)))
-                    
-                # ユーザーステータスを更新
-                querys.update_user_status(user_status)
-
-                # 応答内容をLINEで送信
-                line_bot_api.reply_message(event.reply_token, reply_data) 
+                    # 復習する問題が無くなったら復習終了
+                    user_status.status = '0'
+                    user_status.current_diary_id = None
+                    user_status.current_question_no = None
+                    reply_data.append(TextSendMessage(text='今日の復習は以上です。'))
+            elif user_status.status == '2':
+                graph.flow = 'message:ask'
+                # 質問中の場合、AI応答を生成して応答を返す
+                diary = graph.get('diary')
+                response = graph.call('generate_ai_message', generate_ai_message, event.message.text, "text/plain", 
+                        system_prompt_asking.format(english_text=diary.english_text, 
+                        japanese_text=diary.japanese_text), deadline)
+                response += '\n' + '（ほかに質問があれば続けてください）'
+                quick_Action = [QuickReplyButton(action=PostbackAction(label='問題を解く', data='try_to_answer',display_text='問題を解く'))]
+                reply_data.append(TextSendMessage(text=response,quick_reply=QuickReply(items=quick_Action)))
             else:
-                continue
+                if graph.flow == 'message':
+                    graph.flow = 'message:diary'
+                # 上記以外の場合、クイックリプライにPostbackアクションを入れたボタンを作る
+                quick_Action = [QuickReplyButton(action=PostbackAction(label='問題を解く', data='try_to_answer',display_text='問題を解く'))
+                    ,QuickReplyButton(action=PostbackAction(label='質問する', data='ask_question',display_text='質問する'))]
+                # 日記の英文をメッセージに編集
+                diary = graph.get('diary')
+                reply_data.append(TextSendMessage(text=diary.english_text,quick_reply=QuickReply(items=quick_Action)))
+
+            # ユーザーステータスを更新（他の更新と並行して実行）
+            graph.add('update_user_status', opstore.update_user_status, user_status, deadline)
+            updates.append('update_user_status')
+            # 更新の完了を待つ
+            for name in updates:
+                graph.get(name)
 
-        elif isinstance(event, PostbackEvent):
+    elif isinstance(event, PostbackEvent):
+        with TaskGraph(f'postback:{event.postback.data}') as graph:
             # ポストバックイベントの場合、ユーザーステータスを取得
-            user_status = querys.select_user_status(event.source.user_id)
-            # 日記データを取得
-            diary = querys.select_diary(user_status.current_diary_id)
+            graph.add('user_status', opstore.select_user_status, event.source.user_id, deadline)
+            user_status = graph.get('user_status')
             if event.postback.data == 'try_to_answer':
                 # 問題を解く場合、1問目を出題
                 # 処理中の問題番号を更新
                 user_status.current_question_no = 1
-                # 問題メッセージを編集
-                reply_data.append(edit_question(diary.id, user_status.current_question_no))
+                # 問題メッセージを編集（ユーザーステータスの更新と並行して実行）
+                graph.add('question', edit_question, user_status.current_diary_id, user_status.current_question_no, deadline)
                 # ユーザーステータスを出題中にする
                 user_status.status = '1'
             elif event.postback.data == 'ask_question':
@@ -217,21 +370,76 @@ def main(request):
                 user_status.status = '2'
                 # 返信メッセージを編集
                 reply_data.append(TextSendMessage(text='質問をどうぞ。'))
+            elif event.postback.data == 'review_mistakes':
+                # 復習する場合、復習期限が最も古い問題を取得
+                if user_status.current_diary_id is not None and user_status.status != '3':
+                    # 今日の日記の出題中・出題前は復習を始めない
+                    reply_data.append(TextSendMessage(text='今日の問題を解き終えてから復習しましょう。'))
+                    return reply_data
+                entry = graph.call('next_mistake', opstore.select_next_mistake, event.source.user_id, today_in_japan(), None, deadline)
+                question = graph.call('review_question', opstore.select_question_by_id, entry.question_id, deadline) if entry else None
+                if question is None:
+                    reply_data.append(TextSendMessage(text='今日復習する問題はありません。'))
+                    return reply_data
+                # 処理中の日記IDと問題番号を復習する問題に合わせ、ユーザーステータスを復習中にする
+                user_status.current_diary_id = question.diary_id
+                user_status.current_question_no = question.question_no
+                user_status.status = '3'
+                # 問題メッセージを編集
+                reply_data.append(TextSendMessage(text='以前間違えた問題を復習します。'))
+                reply_data.append(graph.call('edit_question', edit_question, question.diary_id, question.question_no, deadline))
 
             # ユーザーステータス更新
-            querys.update_user_status(user_status)
-            # 応答内容をLINEで送信
-            line_bot_api.reply_message(event.reply_token, reply_data) 
+            graph.add('update_user_status', opstore.update_user_status, user_status, deadline)
+            if event.postback.data == 'try_to_answer':
+                reply_data.append(graph.get('question'))
+            graph.get('update_user_status')
 
-    return jsonify({ 'message': 'ok'})
+    return reply_data
+
+
+'''
+日本時間の今日の日付を返す
+'''
+def today_in_japan() -> date:
+    # タイムゾーン設定
+    timezone_japan = pytz.timezone('Asia/Tokyo')
+    # 日本時間の現在時刻を取得
+    now_japan = datetime.now(pytz.utc).astimezone(timezone_japan)
+    # 日付のみに絞り込む
+    return now_japan.date()
+
+
+'''
+復習ボタンのクイックリプライを返す
+'''
+def review_quick_reply() -> QuickReply:
+    return QuickReply(items=[QuickReplyButton(action=PostbackAction(label='復習する', data='review_mistakes', display_text='復習する'))])
+
+
+'''
+ローディングアニメーションを開始する
+'''
+def start_loading_animation(user_id: str, deadline: Optional[Deadline] = None):
+    url_loading = 'https://api.line.me/v2/bot/chat/loading/start'
+    headers_loading = {
+        'Content-Type': 'application/json',
+        "Authorization": f'Bearer {channel_access_token}'
+    }
+    payload_loading = {
+        "chatId": user_id,
+        "loadingSeconds": 40
+    }
+    return requests.post(url_loading, headers=headers_loading, data=json.dumps(payload_loading),
+        timeout=deadline.timeout() if deadline else None)
 
 
 '''
 日記・問題・選択肢にデータを追加する
 '''
-def create_diary(user_id: str, message_text: str, diary_date: date) -> int:
+def create_diary(user_id: str, message_text: str, diary_date: date, deadline: Optional[Deadline] = None) -> int:
     # 日記用のデータをAIで生成する
-    response = generate_ai_message(message_text, "application/json", system_prompt_diary)
+    response = generate_ai_message(message_text, "application/json", system_prompt_diary, deadline)
     # 応答内容から各テーブルにレコードを追加する
     data = json.loads(response)
     # 日記テーブル追加
@@ -244,7 +452,7 @@ def create_diary(user_id: str, message_text: str, diary_date: date) -> int:
         japanese_text=data['translation'],
         number_of_correct_answers=0
     )
-    diary_id = querys.insert_diary(diaryEntry)
+    diary_id = opstore.insert_diary(diaryEntry, deadline)
     # 問題テーブル追加（AI応答のexercises内question）
     for exercise in data['exercises'] :
         questionEntry = Question(
@@ -253,9 +461,10 @@ def create_diary(user_id: str, message_text: str, diary_date: date) -> int:
             question_no=exercise['question_no'],
             question_text=exercise['question'],
             explanation_text=exercise['explanation'],
-            mistake_flag=False
+            mistake_flag=False,
+            question_type=exercise.get('question_type')
         )
-        question_id = querys.insert_question(questionEntry)
+        question_id = opstore.insert_question(questionEntry, deadline)
         # 選択肢テーブル追加（AI応答のexercises内options）
         for option in exercise['options'] :
             correct_flag = exercise['answer'] == option['option_no']
@@ -266,15 +475,16 @@ def create_diary(user_id: str, message_text: str, diary_date: date) -> int:
                 option_text=option['option'],
                 correct_flag=correct_flag
             )
-            querys.insert_option(option)
+            opstore.insert_option(option, deadline)
     # 作成した日記IDを返す
     return diary_id
 
 '''
 AIモデルの応答テキストを返す
 パラメータがある場合はシステムパラメータに設定する
+処理期限がある場合は残り時間をタイムアウトに設定し、Geminiの遮断器を通して呼び出す
 '''
-def generate_ai_message(message: str, response_mime_type: str, system_prompt: Optional[str]) -> str:
+def generate_ai_message(message: str, response_mime_type: str, system_prompt: Optional[str], deadline: Optional[Deadline] = None) -> str:
     # Gemini AIモデルを生成
     genai.configure(api_key=gemini_api_key)
     # チャットの応答を生成
@@ -283,21 +493,36 @@ def generate_ai_message(message: str, response_mime_type: str, system_prompt: Op
         system_instruction=system_prompt,
     )
     
+    # 期限切れは呼び出し前に判定する（自分の期限切れを Gemini の失敗として数えない）
+    timeout = deadline.timeout() if deadline else None
+    # 遮断中なら呼び出さずに失敗を返す（試行を許可した後は必ず成否を記録する）
+    gemini_breaker.before_call()
     # チャットの応答を生成
-    response = model.generate_content(
-        message,
-        generation_config={"response_mime_type": response_mime_type})
-    return response.text
+    try:
+        response = model.generate_content(
+            message,
+            generation_config={"response_mime_type": response_mime_type},
+            request_options={"timeout": timeout} if deadline else None)
+        text = response.text
+    except Exception as e:
+        if deadline is not None and deadline.expired():
+            # 期限切れで打ち切った呼び出しは Gemini の失敗として数えない
+            gemini_breaker.record_abandoned()
+            raise DeadlineExceeded(f'Geminiの応答が期限内に返りませんでした：{e}') from e
+        gemini_breaker.record_failure()
+        raise
+    gemini_breaker.record_success()
+    return text
 
 
 '''
 問題メッセージを編集する
 '''
-def edit_question(diary_id: int, question_no: int) -> TextSendMessage :
+def edit_question(diary_id: int, question_no: int, deadline: Optional[Deadline] = None) -> TextSendMessage :
     # 問題データを取得する
-    question = querys.select_question(diary_id, question_no)
+    question = opstore.select_question(diary_id, question_no, deadline)
     # 選択肢データを取得する
-    options = querys.select_option(question.id)
+    options = opstore.select_option(question.id, deadline)
     # 選択肢用のクイックリプライを編集する
     question_and_options = question.question_text
     optionList =[]
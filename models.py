@@ -1,6 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import date
-from typing import Optional
+from typing import Optional, List, Dict
 
 @dataclass
 class UserStatus:
@@ -32,6 +32,7 @@ class Question:
     question_text: str
     explanation_text: str
     mistake_flag: Optional[bool]
+    question_type: Optional[str] = None
 
 @dataclass
 class Options:
@@ -40,4 +41,44 @@ class Options:
     question_id: int
     option_no: int
     option_text: str
-    correct_flag: bool
\ No newline at end of file
+    correct_flag: bool
+
+
+@dataclass
+class UserStats:
+    '''ユーザー成績テーブルのデータクラス'''
+    user_id: str
+    current_streak: int
+    longest_streak: int
+    last_quiz_date: Optional[date]
+    total_quizzes: int
+    total_questions: int
+    total_correct: int
+    # 直近30日分の日別成績（日付（ISO形式）: [正解数, 出題数]）
+    daily_results: Dict[str, List[int]] = field(default_factory=dict)
+    # 問題の種類ごとの誤答数
+    missed_types: Dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class MistakeEntry:
+    '''誤答インデックステーブルのデータクラス'''
+    user_id: str
+    question_id: int
+    due_date: date
+    interval_days: int
+    repetitions: int
+
+
+@dataclass
+class QuestionHistory:
+    '''履歴出力用の問題と選択肢のデータクラス'''
+    question: Question
+    options: List[Options] = field(default_factory=list)
+
+
+@dataclass
+class DiaryHistory:
+    '''履歴出力用の日記と問題のデータクラス'''
+    diary: Diary
+    questions: List[QuestionHistory] = field(default_factory=list)
@@ -0,0 +1,493 @@
+from google.cloud import firestore
+import json
+import threading
+from dataclasses import asdict, fields
+from datetime import date
+from logging import getLogger
+from models import UserStatus, Diary, Question, Options, UserStats, MistakeEntry
+from typing import Optional, List
+from resilience import Deadline, DeadlineExceeded, CircuitBreaker, Unavailable
+
+'''
+会話処理用のデータストア（Firestore）
+    会話処理で使うデータの読み書きを、低レイテンシのFirestoreで提供する（BigQueryは分析・エクスポート用）
+    各テーブルのドキュメントはBigQueryの行と同じ形（日付はISO形式、辞書はJSON文字列）で保持する
+    追加・更新・削除のたびに、同じバッチで変更ログ（change_log）に変更後の行を追記する
+    変更ログは exporter.py が定期的にBigQueryの各テーブルへまとめて反映する
+'''
+# 変更ログのコレクション名
+change_log_collection = 'change_log'
+# ID採番用のコレクション名
+counter_collection = 'counters'
+# 1回の採番で確保するIDの数（カウンタードキュメントへの書き込みを減らす）
+id_block_size = 100
+# 日付の項目（ISO形式の文字列で保持する）
+date_fields = {'latest_diary_date', 'diary_date', 'last_quiz_date', 'due_date'}
+# 辞書の項目（JSON文字列で保持する）
+json_fields = {'daily_results', 'missed_types'}
+
+# Firestoreインスタンスの作成
+db = firestore.Client()
+# loggerの取得
+logger = getLogger(__name__)
+# Firestoreの遮断器
+firestore_breaker = CircuitBreaker('Firestore')
+
+
+'''
+ユーザーステータステーブルINSERT
+'''
+def insert_user_status(userStatus: UserStatus, deadline: Optional[Deadline] = None):
+    try:
+        write('user_status', userStatus.user_id, to_row(userStatus), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'insert_user_statusでエラー発生：{e}')
+
+
+'''
+日記テーブルINSERT
+'''
+def insert_diary(diaryEntry: Diary, deadline: Optional[Deadline] = None) -> Optional[int]:
+    try:
+        # ID採番
+        id = get_id('diary', deadline)
+        row = to_row(diaryEntry)
+        row['id'] = id
+        write('diary', str(id), row, deadline)
+        return id
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'insert_diaryでエラー発生：{e}')
+        return None
+
+
+'''
+問題テーブルINSERT
+'''
+def insert_question(questionEntry: Question, deadline: Optional[Deadline] = None) -> Optional[int]:
+    try:
+        # ID採番
+        id = get_id('question', deadline)
+        row = to_row(questionEntry)
+        row['id'] = id
+        write('question', str(id), row, deadline)
+        return id
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'insert_questionでエラー発生：{e}')
+        return None
+
+
+'''
+選択肢テーブルINSERT
+'''
+def insert_option(optionEntry: Options, deadline: Optional[Deadline] = None):
+    try:
+        # ID採番
+        id = get_id('options', deadline)
+        row = to_row(optionEntry)
+        row['id'] = id
+        write('options', str(id), row, deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'insert_optionでエラー発生：{e}')
+
+
+'''
+ユーザーステータステーブルSELECT（ユーザーIDから取得）
+'''
+def select_user_status(user_id: str, deadline: Optional[Deadline] = None) -> Optional[UserStatus]:
+    # 取得に失敗した場合は例外を送出する（Noneを返すと新規ユーザーとして扱われ、ユーザーステータスを上書きしてしまうため）
+    row = read('user_status', user_id, deadline)
+    return from_row(UserStatus, row) if row else None
+
+
+'''
+日記テーブルSELECT（IDから取得）
+'''
+def select_diary(id: int, deadline: Optional[Deadline] = None) -> Optional[Diary]:
+    try:
+        row = read('diary', str(id), deadline)
+        return from_row(Diary, row) if row else None
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_diaryでエラー発生：{e}')
+        return None
+
+
+'''
+質問テーブルSELECT（日記IDと問題番号から取得）
+'''
+def select_question(diary_id: int, question_no: int, deadline: Optional[Deadline] = None) -> Optional[Question]:
+    try:
+        query = (db.collection('question')
+            .where(filter=firestore.FieldFilter('diary_id', '==', diary_id))
+            .where(filter=firestore.FieldFilter('question_no', '==', question_no))
+            .limit(1))
+        rows = run(lambda timeout: [snapshot.to_dict() for snapshot in query.get(timeout=timeout)], deadline)
+        return from_row(Question, rows[0]) if rows else None
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_questionでエラー発生：{e}')
+        return None
+
+
+'''
+質問テーブルSELECT（IDから取得）
+'''
+def select_question_by_id(id: int, deadline: Optional[Deadline] = None) -> Optional[Question]:
+    try:
+        row = read('question', str(id), deadline)
+        return from_row(Question, row) if row else None
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_question_by_idでエラー発生：{e}')
+        return None
+
+
+'''
+質問テーブルSELECT（日記IDのリストから取得）
+'''
+def select_questions_by_diary_ids(diary_ids: List[int], deadline: Optional[Deadline] = None) -> List[Question]:
+    try:
+        query = db.collection('question').where(filter=firestore.FieldFilter('diary_id', 'in', diary_ids))
+        rows = run(lambda timeout: [snapshot.to_dict() for snapshot in query.get(timeout=timeout)], deadline)
+        questions = [from_row(Question, row) for row in rows]
+        return sorted(questions, key=lambda question: (question.diary_id, question.question_no))
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_questions_by_diary_idsでエラー発生：{e}')
+        return []
+
+
+'''
+選択肢テーブルSELECT（問題IDから取得）
+'''
+def select_option(question_id: int, deadline: Optional[Deadline] = None) -> List[Options]:
+    try:
+        query = db.collection('options').where(filter=firestore.FieldFilter('question_id', '==', question_id))
+        rows = run(lambda timeout: [snapshot.to_dict() for snapshot in query.get(timeout=timeout)], deadline)
+        # 選択肢番号順に並べる（件数が少ないため複合インデックスは使わない）
+        return sorted((from_row(Options, row) for row in rows), key=lambda option: option.option_no)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_optionでエラー発生：{e}')
+        return []
+
+
+'''
+正解判定（選択肢テーブルを問題番号と選択肢番号、正解フラグで取得してデータがあればtrueを返す）
+'''
+def is_correct(question_id: int, option_no: int, deadline: Optional[Deadline] = None) -> bool:
+    try:
+        query = (db.collection('options')
+            .where(filter=firestore.FieldFilter('question_id', '==', question_id))
+            .where(filter=firestore.FieldFilter('option_no', '==', option_no))
+            .where(filter=firestore.FieldFilter('correct_flag', '==', True))
+            .limit(1))
+        rows = run(lambda timeout: query.get(timeout=timeout), deadline)
+        return len(rows) > 0
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'is_correctでエラー発生：{e}')
+        return False
+
+
+'''
+ユーザーステータステーブル更新
+'''
+def update_user_status(userStatus: UserStatus, deadline: Optional[Deadline] = None):
+    try:
+        write('user_status', userStatus.user_id, to_row(userStatus), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'update_user_statusでエラー発生：{e}')
+
+
+'''
+日記テーブル更新（正解数を更新する）
+'''
+def update_diary(diaryEntry: Diary, deadline: Optional[Deadline] = None):
+    try:
+        write('diary', str(diaryEntry.id), to_row(diaryEntry), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'update_diaryでエラー発生：{e}')
+
+
+'''
+問題テーブル更新（誤答フラグを更新する）
+    変更ログには更新後の行全体を残すため、トランザクションで読み込んでから更新する
+'''
+def update_question(question_id: int, deadline: Optional[Deadline] = None):
+    ref = db.collection('question').document(str(question_id))
+
+    @firestore.transactional
+    def set_mistake_flag(transaction, timeout):
+        snapshot = ref.get(transaction=transaction, timeout=timeout)
+        if not snapshot.exists:
+            return
+        row = snapshot.to_dict()
+        row['mistake_flag'] = True
+        transaction.set(ref, row)
+        transaction.set(db.collection(change_log_collection).document(), change_entry('question', 'upsert', row))
+
+    try:
+        run(lambda timeout: set_mistake_flag(db.transaction(), timeout), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'update_questionでエラー発生：{e}')
+
+
+'''
+ユーザー成績テーブルSELECT（ユーザーIDから取得）
+'''
+def select_user_stats(user_id: str, deadline: Optional[Deadline] = None) -> Optional[UserStats]:
+    # 取得に失敗した場合は例外を送出する（Noneを返すと未受験として成績を上書きしてしまうため）
+    row = read('user_stats', user_id, deadline)
+    return from_row(UserStats, row) if row else None
+
+
+'''
+ユーザー成績テーブル更新（ユーザーIDが無ければ追加、あれば全項目を更新する）
+'''
+def upsert_user_stats(userStats: UserStats, deadline: Optional[Deadline] = None):
+    try:
+        write('user_stats', userStats.user_id, to_row(userStats), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'upsert_user_statsでエラー発生：{e}')
+
+
+'''
+誤答インデックステーブルSELECT（ユーザーIDと問題IDから取得）
+'''
+def select_mistake(user_id: str, question_id: int, deadline: Optional[Deadline] = None) -> Optional[MistakeEntry]:
+    # 取得に失敗した場合は例外を送出する（Noneを返すと未登録として扱われ、復習予定が削除されてしまうため）
+    row = read('mistake_index', f'{user_id}_{question_id}', deadline)
+    return from_row(MistakeEntry, row) if row else None
+
+
+'''
+誤答インデックステーブルSELECT（ユーザーの復習期限が来ている問題のうち、期限が最も古いものを1件取得）
+    (user_id, due_date) の複合インデックスを使って取得する
+    exclude_question_idを指定した場合はその問題を除く（更新中の問題を再度選ばないため）
+'''
+def select_next_mistake(user_id: str, today: date, exclude_question_id: Optional[int] = None,
+        deadline: Optional[Deadline] = None) -> Optional[MistakeEntry]:
+    try:
+        query = (db.collection('mistake_index')
+            .where(filter=firestore.FieldFilter('user_id', '==', user_id))
+            .where(filter=firestore.FieldFilter('due_date', '<=', today.isoformat()))
+            .order_by('due_date')
+            .limit(2))
+        rows = run(lambda timeout: [snapshot.to_dict() for snapshot in query.get(timeout=timeout)], deadline)
+        for row in rows:
+            if row['question_id'] != exclude_question_id:
+                return from_row(MistakeEntry, row)
+        return None
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'select_next_mistakeでエラー発生：{e}')
+        return None
+
+
+'''
+誤答インデックステーブル更新（ユーザーIDと問題IDが無ければ追加、あれば復習期限などを更新する）
+'''
+def upsert_mistake(mistakeEntry: MistakeEntry, deadline: Optional[Deadline] = None):
+    try:
+        write('mistake_index', f'{mistakeEntry.user_id}_{mistakeEntry.question_id}', to_row(mistakeEntry), deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'upsert_mistakeでエラー発生：{e}')
+
+
+'''
+誤答インデックステーブルDELETE（復習を終えた問題を削除する）
+'''
+def delete_mistake(user_id: str, question_id: int, deadline: Optional[Deadline] = None):
+    try:
+        delete('mistake_index', f'{user_id}_{question_id}',
+            {'user_id': user_id, 'question_id': question_id}, deadline)
+    except Unavailable:
+        # 期限切れ・遮断中の場合は呼び出し元で縮退応答する
+        raise
+    except Exception as e:
+        # 例外が発生した場合、ログにエラーを出力
+        logger.error(f'delete_mistakeでエラー発生：{e}')
+
+
+'''
+ID採番
+    カウンタードキュメントからid_block_size件ずつIDを確保し、確保した範囲から順に払い出す
+    IDは重複しないが、インスタンスごとに確保するため連番にはならない
+'''
+class IdAllocator:
+
+    def __init__(self, table: str):
+        self.table = table
+        self.next_id = 0
+        self.last_id = -1
+        self.lock = threading.Lock()
+
+    def allocate(self, deadline: Optional[Deadline]) -> int:
+        with self.lock:
+            if self.next_id > self.last_id:
+                # 確保済みのIDを使い切ったら次のブロックを確保する
+                ref = db.collection(counter_collection).document(self.table)
+                self.last_id = run(lambda timeout: reserve_ids(db.transaction(), ref, timeout), deadline)
+                self.next_id = self.last_id - id_block_size + 1
+            id = self.next_id
+            self.next_id += 1
+            return id
+
+
+@firestore.transactional
+def reserve_ids(transaction, ref, timeout) -> int:
+    snapshot = ref.get(transaction=transaction, timeout=timeout)
+    last_id = (snapshot.get('value') if snapshot.exists else 0) + id_block_size
+    transaction.set(ref, {'value': last_id})
+    return last_id
+
+
+id_allocators = {table: IdAllocator(table) for table in ['diary', 'question', 'options']}
+
+
+def get_id(table: str, deadline: Optional[Deadline] = None) -> int:
+    return id_allocators[table].allocate(deadline)
+
+
+'''
+ドキュメントを1件取得する（無ければNone）
+'''
+def read(table: str, doc_id: str, deadline: Optional[Deadline]) -> Optional[dict]:
+    ref = db.collection(table).document(doc_id)
+    snapshot = run(lambda timeout: ref.get(timeout=timeout), deadline)
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+'''
+ドキュメントを書き込み、同じバッチで変更ログを追記する
+'''
+def write(table: str, doc_id: str, row: dict, deadline: Optional[Deadline]):
+    batch = db.batch()
+    batch.set(db.collection(table).document(doc_id), row)
+    batch.set(db.collection(change_log_collection).document(), change_entry(table, 'upsert', row))
+    run(lambda timeout: batch.commit(timeout=timeout), deadline)
+
+
+'''
+ドキュメントを削除し、同じバッチで変更ログを追記する（key_rowは削除する行のキー項目）
+'''
+def delete(table: str, doc_id: str, key_row: dict, deadline: Optional[Deadline]):
+    batch = db.batch()
+    batch.delete(db.collection(table).document(doc_id))
+    batch.set(db.collection(change_log_collection).document(), change_entry(table, 'delete', key_row))
+    run(lambda timeout: batch.commit(timeout=timeout), deadline)
+
+
+'''
+変更ログのエントリを編集する
+'''
+def change_entry(table: str, op: str, row: dict) -> dict:
+    return {'table': table, 'op': op, 'row': row, 'changed_at': firestore.SERVER_TIMESTAMP}
+
+
+'''
+データクラスをBigQueryの行と同じ形の辞書に変換する
+'''
+def to_row(entry) -> dict:
+    row = asdict(entry)
+    for name, value in row.items():
+        if name in date_fields and value is not None:
+            row[name] = value.isoformat()
+        elif name in json_fields:
+            row[name] = json.dumps(value, ensure_ascii=False)
+    return row
+
+
+'''
+BigQueryの行と同じ形の辞書をデータクラスに変換する
+'''
+def from_row(cls, row: dict):
+    values = {}
+    for field in fields(cls):
+        value = row.get(field.name)
+        if field.name in date_fields and value is not None:
+            value = date.fromisoformat(value)
+        elif field.name in json_fields:
+            value = json.loads(value or '{}')
+        values[field.name] = value
+    return cls(**values)
+
+
+'''
+Firestoreの呼び出し
+    期限の残り時間をタイムアウトに設定し、Firestoreの遮断器を通して実行する
+    呼び出し前に期限を過ぎている場合は、遮断器に記録せずにDeadlineExceededを送出する
+'''
+def run(operation, deadline: Optional[Deadline]):
+    # 期限切れは呼び出し前に判定する（自分の期限切れを Firestore の失敗として数えない）
+    timeout = deadline.timeout() if deadline else None
+    firestore_breaker.before_call()
+    try:
+        result = operation(timeout)
+    except Exception as e:
+        if deadline is not None and deadline.expired():
+            # 期限切れで打ち切った呼び出しは Firestore の失敗として数えない
+            firestore_breaker.record_abandoned()
+            raise DeadlineExceeded(f'Firestoreの処理が期限内に終わりませんでした：{e}') from e
+        firestore_breaker.record_failure()
+        raise
+    firestore_breaker.record_success()
+    return result
@@ -0,0 +1,115 @@
+import threading
+import time
+from logging import getLogger
+from typing import Optional
+
+# loggerの取得
+logger = getLogger(__name__)
+
+
+class Unavailable(Exception):
+    '''外部サービスを利用できない（期限切れ・遮断中）ことを表す例外'''
+
+
+class DeadlineExceeded(Unavailable):
+    '''処理期限を過ぎたことを表す例外'''
+
+
+class CircuitOpen(Unavailable):
+    '''遮断器が開いていて呼び出しを行わなかったことを表す例外'''
+
+
+'''
+処理期限
+    リクエストを受けた時点から使える秒数を持ち、各呼び出しに残り時間を渡す
+'''
+class Deadline:
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    '''
+    残り秒数を返す（期限を過ぎていれば0）
+    '''
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    '''
+    期限を過ぎているかどうか
+    '''
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    '''
+    呼び出しのタイムアウト秒数を返す
+    期限を過ぎている場合は呼び出し前にDeadlineExceededを送出する
+    '''
+    def timeout(self) -> float:
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('処理期限を過ぎました')
+        return remaining
+
+
+'''
+遮断器（サーキットブレーカー）
+    連続してfailure_threshold回失敗すると開き、reset_seconds秒の間は呼び出さずに失敗を返す
+    reset_seconds秒経過後は1件だけ試行し、成功すれば閉じ、失敗すれば再び開く
+'''
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        # 連続失敗回数
+        self.failures = 0
+        # 開いた時刻（閉じている場合はNone）
+        self.opened_at: Optional[float] = None
+        # 試行中かどうか（開いた後の試行は1件だけ通す）
+        self.trial = False
+        self.lock = threading.Lock()
+
+    '''
+    呼び出し前の確認
+    開いている場合はCircuitOpenを送出する
+    '''
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpen(f'{self.name}の遮断器が開いています')
+            # 一定時間経過したため試行を1件通す
+            self.trial = True
+
+    '''
+    呼び出し成功を記録する
+    '''
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f'{self.name}の遮断器を閉じました')
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    '''
+    呼び出し失敗を記録する
+    '''
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    logger.warning(f'{self.name}の遮断器を開きました（連続失敗{self.failures}回）')
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    '''
+    処理期限切れで打ち切った呼び出しを記録する
+    呼び出し先の失敗とは限らないため失敗として数えず、試行中であれば次の試行を許可する
+    '''
+    def record_abandoned(self):
+        with self.lock:
+            self.trial = False
@@ -0,0 +1,43 @@
+from datetime import date, timedelta
+from typing import Optional
+
+from models import MistakeEntry
+
+# 復習間隔（日数）。正解するたびに次の間隔へ進み、最後の間隔で正解したら復習を終える
+review_intervals = [1, 3, 7, 14, 30]
+
+
+'''
+間違えた問題を誤答インデックスに登録する内容を返す（翌日から復習する）
+'''
+def schedule_mistake(user_id: str, question_id: int, today: date) -> MistakeEntry:
+    return MistakeEntry(
+        user_id=user_id,
+        question_id=question_id,
+        due_date=today + timedelta(days=review_intervals[0]),
+        interval_days=review_intervals[0],
+        repetitions=0
+    )
+
+
+'''
+復習の解答結果から次の復習予定を返す
+    正解の場合は次の間隔へ進め、最後の間隔で正解した場合はNone（復習終了）を返す
+    不正解の場合は最初の間隔からやり直す
+'''
+def schedule_review(entry: Optional[MistakeEntry], user_id: str, question_id: int,
+        correct: bool, today: date) -> Optional[MistakeEntry]:
+    if not correct:
+        return schedule_mistake(user_id, question_id, today)
+    if entry is None:
+        return None
+    repetitions = entry.repetitions + 1
+    if repetitions >= len(review_intervals):
+        return None
+    return MistakeEntry(
+        user_id=user_id,
+        question_id=question_id,
+        due_date=today + timedelta(days=review_intervals[repetitions]),
+        interval_days=review_intervals[repetitions],
+        repetitions=repetitions
+    )
@@ -0,0 +1,92 @@
+from datetime import date, timedelta
+from typing import Optional, List
+
+from models import UserStats
+
+# 日別成績を保持する日数
+history_days = 30
+
+
+'''
+出題終了時の成績を反映した新しいユーザー成績を返す
+    stats : 現在のユーザー成績（初回はNone）
+    missed_types : 今回不正解だった問題の種類のリスト
+'''
+def apply_quiz_result(stats: Optional[UserStats], user_id: str, quiz_date: date,
+        correct: int, total: int, missed_types: List[Optional[str]]) -> UserStats:
+    if stats is None:
+        stats = UserStats(
+            user_id=user_id,
+            current_streak=0,
+            longest_streak=0,
+            last_quiz_date=None,
+            total_quizzes=0,
+            total_questions=0,
+            total_correct=0
+        )
+    # 連続日数を更新（同じ日の2回目は据え置き、前日から続いていれば+1、途切れていれば1から）
+    if stats.last_quiz_date == quiz_date:
+        current_streak = max(stats.current_streak, 1)
+    elif stats.last_quiz_date == quiz_date - timedelta(days=1):
+        current_streak = stats.current_streak + 1
+    else:
+        current_streak = 1
+    # 日別成績に今回の結果を加算し、保持期間より古い日付を削除
+    oldest = (quiz_date - timedelta(days=history_days - 1)).isoformat()
+    daily_results = {day: result for day, result in stats.daily_results.items() if day >= oldest}
+    day_correct, day_total = daily_results.get(quiz_date.isoformat(), [0, 0])
+    daily_results[quiz_date.isoformat()] = [day_correct + correct, day_total + total]
+    # 問題の種類ごとの誤答数を加算
+    missed = dict(stats.missed_types)
+    for question_type in missed_types:
+        key = question_type or 'その他'
+        missed[key] = missed.get(key, 0) + 1
+
+    return UserStats(
+        user_id=stats.user_id,
+        current_streak=current_streak,
+        longest_streak=max(stats.longest_streak, current_streak),
+        last_quiz_date=quiz_date,
+        total_quizzes=stats.total_quizzes + 1,
+        total_questions=stats.total_questions + total,
+        total_correct=stats.total_correct + correct,
+        daily_results=daily_results,
+        missed_types=missed
+    )
+
+
+'''
+指定日までの直近days日間の正答率を返す（出題が無い場合はNone）
+'''
+def accuracy(stats: UserStats, today: date, days: int = history_days) -> Optional[float]:
+    oldest = (today - timedelta(days=days - 1)).isoformat()
+    correct = total = 0
+    for day, (day_correct, day_total) in stats.daily_results.items():
+        if oldest <= day <= today.isoformat():
+            correct += day_correct
+            total += day_total
+    if total == 0:
+        return None
+    return correct / total
+
+
+'''
+誤答数の多い問題の種類を多い順に返す
+'''
+def most_missed_types(stats: UserStats, limit: int = 3) -> List[str]:
+    ranked = sorted(stats.missed_types.items(), key=lambda item: (-item[1], item[0]))
+    return [question_type for question_type, _ in ranked[:limit]]
+
+
+'''
+チャットに表示する成績メッセージを編集する
+'''
+def progress_message(stats: UserStats, today: date) -> str:
+    lines = [f'連続{stats.current_streak}日目（最長{stats.longest_streak}日）、これまでに{stats.total_quizzes}回挑戦しました。']
+    rate = accuracy(stats, today)
+    if rate is not None:
+        lines.append(f'直近{history_days}日間の正答率は{rate * 100:.0f}%です。')
+    missed = most_missed_types(stats)
+    if missed:
+        lines.append(f'間違えやすい問題：{"、".join(missed)}')
+    return '\n'.join(lines)
@@ -0,0 +1,130 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from logging import getLogger
+from typing import Any, Callable, Dict, List
+
+# loggerの取得
+logger = getLogger(__name__)
+
+# 全イベントで共有するスレッドプール
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='taskgraph')
+
+
+'''
+依存関係付きの並列実行
+    add() で登録した処理はすぐにスレッドプールで実行を開始する
+    依存先（deps）がある処理は、依存先の結果を引数の先頭に受け取って実行する
+    結果が必要な箇所でだけ get() で待つため、独立した処理は同時に進む
+    get() で待ち終えた処理は、その後に add() した処理の暗黙の依存先として記録する
+    （呼び出し元で結果を見てから次の処理を登録する順序もクリティカルパスに含めるため）
+    close() で全処理の完了を待ち、フローごとのクリティカルパス長をログに出力する
+'''
+class TaskGraph:
+
+    def __init__(self, flow: str):
+        # フロー名（ログ出力用）
+        self.flow = flow
+        # 処理名ごとのFuture
+        self.futures: Dict[str, Future] = {}
+        # 処理名ごとの依存先
+        self.deps: Dict[str, List[str]] = {}
+        # 処理名ごとの暗黙の依存先（登録時点で get() 済みの処理）
+        self.after: Dict[str, List[str]] = {}
+        # get() で待ち終えた処理名
+        self.awaited: List[str] = []
+        # 処理名ごとの実行時間（依存先の待ち時間を除く）
+        self.durations: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    '''
+    処理を登録して実行を開始する
+        依存先は登録済みの処理名のみ指定できる
+        （先に登録した処理から順に実行されるため、依存先の待ちでスレッドが詰まらない）
+    '''
+    def add(self, name: str, fn: Callable, *args, deps: List[str] = (), **kwargs):
+        if name in self.futures:
+            raise ValueError(f'処理名{name}は登録済みです')
+        for dep in deps:
+            if dep not in self.futures:
+                raise ValueError(f'依存先{dep}が未登録です')
+        self.deps[name] = list(deps)
+        self.after[name] = [awaited for awaited in self.awaited if awaited not in deps]
+        self.futures[name] = executor.submit(self._run, name, fn, args, kwargs)
+
+    '''
+    処理の結果を返す（完了していなければ待つ）
+    処理で例外が発生していた場合は、その例外を送出する
+    '''
+    def get(self, name: str) -> Any:
+        try:
+            return self.futures[name].result()
+        finally:
+            if name not in self.awaited:
+                self.awaited.append(name)
+
+    '''
+    処理を登録して結果を待つ（呼び出し元で順に実行する処理も計測に含めるため）
+    '''
+    def call(self, name: str, fn: Callable, *args, deps: List[str] = (), **kwargs) -> Any:
+        self.add(name, fn, *args, deps=deps, **kwargs)
+        return self.get(name)
+
+    '''
+    全処理の完了を待ってから計測結果をログに出力する
+    '''
+    def close(self):
+        for future in list(self.futures.values()):
+            # 例外は get() の呼び出し元で扱うため、ここでは完了を待つだけ
+            future.exception()
+        if not self.futures:
+            return
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.durations.values())
+        critical_path = self.critical_path()
+        logger.info(f'{self.flow}: wall={elapsed * 1000:.0f}ms '
+                    f'critical_path={critical_path * 1000:.0f}ms ({" > ".join(self.critical_path_names())}) '
+                    f'sum={total * 1000:.0f}ms tasks={len(self.futures)}')
+
+    '''
+    クリティカルパス長（依存関係をたどった実行時間の合計の最大値）を返す
+    '''
+    def critical_path(self) -> float:
+        paths = {}
+        return max((self._path(name, paths)[0] for name in self.futures), default=0.0)
+
+    '''
+    クリティカルパス上の処理名を先頭から順に返す
+    '''
+    def critical_path_names(self) -> List[str]:
+        if not self.futures:
+            return []
+        paths = {}
+        last = max(self.futures, key=lambda name: self._path(name, paths)[0])
+        return self._path(last, paths)[1]
+
+    def _path(self, name: str, paths: dict):
+        # 依存先（暗黙の依存先を含む）の中で最も長いパスに自身の実行時間を足す
+        if name not in paths:
+            length, names = 0.0, []
+            for dep in self.deps[name] + self.after[name]:
+                dep_length, dep_names = self._path(dep, paths)
+                if dep_length > length:
+                    length, names = dep_length, dep_names
+            paths[name] = (length + self.durations.get(name, 0.0), names + [name])
+        return paths[name]
+
+    def _run(self, name: str, fn: Callable, args: tuple, kwargs: dict):
+        # 依存先の結果を待つ
+        dep_results = [self.futures[dep].result() for dep in self.deps[name]]
+        started = time.perf_counter()
+        try:
+            return fn(*dep_results, *args, **kwargs)
+        finally:
+            self.durations[name] = time.perf_counter() - started